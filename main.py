@@ -2,14 +2,21 @@
 import asyncio
 import json
 import logging
+import math
+import os
 import time
-from typing import Dict, List, Optional, Tuple, Union
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from typing import Awaitable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import httpx
+import orjson
 import redis.asyncio as redis
-from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from cachetools import LRUCache, TLRUCache, TTLCache
+from fastapi import Depends, FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from pydantic import BaseModel, Field
 from redis.commands.timeseries.info import TSInfo
 from redis.exceptions import ResponseError
@@ -22,7 +29,7 @@ logging.basicConfig(
 logger = logging.getLogger("ddos_protection")
 
 # Initialize FastAPI app
-app = FastAPI(title="DDoS Protection API", version="1.0.0")
+app = FastAPI(title="DDoS Protection API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -37,25 +44,81 @@ app.add_middleware(
 REDIS_HOST = "redis"  # Docker service name
 REDIS_PORT = 6379
 REDIS_PASSWORD = None  # Add password in production
+REDIS_MAX_CONNECTIONS = 64  # Size of the shared connection pool
+REDIS_POOL_TIMEOUT = 5  # seconds to wait for a free pooled connection
+
+# Metric ingestion configuration
+METRIC_QUEUE_SIZE = 100000  # Samples buffered before new ones are dropped
+METRIC_FLUSH_INTERVAL = 0.05  # seconds to collect a batch after its first sample
+METRIC_FLUSH_BATCH_SIZE = 1000  # Maximum requests written per TS.MADD
+KNOWN_TS_KEYS_SIZE = 200000  # Path/IP keys remembered as already created
+TS_CHUNK_SIZE = 128  # bytes per compressed TimeSeries chunk
+KEY_CACHE_SIZE = 65536  # Formatted Redis keys cached per key builder
+
+# Heavy hitter configuration
+HEAVY_HITTER_BUCKET = 60  # seconds per sorted-set bucket
+HEAVY_HITTER_BUCKETS = 60  # buckets summed for the last-hour view
+HEAVY_HITTER_SIZE = 1000  # members kept per bucket
+ANOMALY_CANDIDATES = 100  # top paths/IPs checked for anomalies
 
 # Anomaly detection configuration
 WINDOW_SIZE = 60  # seconds
 ZSCORE_THRESHOLD = 3.0  # Standard deviations
-MIN_DATA_POINTS = 30  # Minimum data points required for z-score calculation
+MIN_DATA_POINTS = 30  # Minimum data points in the window (decayed count) for z-score calculation
+GATHER_CHUNK_SIZE = REDIS_MAX_CONNECTIONS // 4  # Concurrent per-key checks in flight
+EWMA_ALPHA = 0.05  # Smoothing factor for the streaming mean and variance
+STATS_SCRIPT = """
+local alpha = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+for i, key in ipairs(KEYS) do
+    local x = tonumber(ARGV[i + 3])
+    local stats = redis.call('HMGET', key, 'count', 'mu', 'var', 'ts')
+    local count = tonumber(stats[1]) or 0
+    local mu = tonumber(stats[2]) or x
+    local var = tonumber(stats[3]) or 0
+    local last = tonumber(stats[4]) or now
+    -- Decay the count so it tracks points seen in roughly the last window
+    count = count * math.exp(-math.max(now - last, 0) / window) + 1
+    local diff = x - mu
+    mu = mu + alpha * diff
+    var = (1 - alpha) * (var + alpha * diff * diff)
+    redis.call('HSET', key, 'count', count, 'mu', mu, 'var', var, 'value', x, 'ts', ARGV[2])
+    redis.call('EXPIRE', key, 86400)
+end
+return #KEYS
+"""
 
 # Rate limiting configuration
 RATE_LIMIT_WINDOW = 60  # seconds
 RATE_LIMIT_MAX_REQUESTS = 1000  # requests per window per IP
+VERIFICATION_TTL = 3600  # seconds a verified IP skips further checks
+DECISION_CACHE_SIZE = 200000  # IPs kept in the in-process decision caches
+RATE_LIMIT_SCRIPT = """
+local v = redis.call('INCR', KEYS[1])
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    ttl = ARGV[1] * 1000
+end
+return {v, ttl}
+"""
 
 # Threat intelligence API configuration
 THREAT_INTEL_API_URL = "https://api.threatintelligence.example/v1/check"
 THREAT_INTEL_API_KEY = "your-api-key"  
+THREAT_INTEL_RISK_THRESHOLD = 70  # risk score above which IPs are blocked
+THREAT_INTEL_CACHE_SIZE = 100000  # IPs kept in each lookup cache
+THREAT_INTEL_CACHE_TTL = 600  # seconds high-risk lookups are cached
+THREAT_INTEL_NEGATIVE_CACHE_TTL = 60  # seconds failed/low-risk lookups are cached
+_MISS = object()  # Cache sentinel, since failed lookups are cached as None
 
 # Cloudflare API configuration
 CLOUDFLARE_API_URL = "https://api.cloudflare.com/client/v4"
 CLOUDFLARE_API_KEY = "your-cloudflare-api-key"  
 CLOUDFLARE_EMAIL = "your-email@example.com"  
 CLOUDFLARE_ZONE_ID = "your-zone-id"  
+AUTO_BLOCK_CONCURRENCY = 16  # Cloudflare block requests in flight
 
 # Models
 class AnomalyDetectionResult(BaseModel):
@@ -95,122 +158,342 @@ class ThreatIntelResult(BaseModel):
 
 # Redis connection pool
 async def get_redis():
-    redis_client = redis.Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        password=REDIS_PASSWORD,
-        decode_responses=True,
-    )
-    try:
-        yield redis_client
-    finally:
-        await redis_client.close()
+    # Shared client created on startup; connections are returned to the pool
+    yield app.state.redis
 
 
 # Initialize Redis TimeSeries keys on startup
 @app.on_event("startup")
 async def startup_event():
-    redis_client = redis.Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        password=REDIS_PASSWORD,
-        decode_responses=True,
+    app.state.redis = redis.Redis(
+        # Blocking pool: callers wait for a free connection instead of failing
+        connection_pool=redis.BlockingConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            password=REDIS_PASSWORD,
+            decode_responses=True,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+        )
+    )
+    redis_client = app.state.redis
+    
+    # Buffer request metrics and write them to Redis in the background
+    app.state.metric_queue = asyncio.Queue(maxsize=METRIC_QUEUE_SIZE)
+    app.state.known_ts_keys = LRUCache(maxsize=KNOWN_TS_KEYS_SIZE)
+    app.state.metric_flusher = asyncio.create_task(metric_flusher(app))
+    app.state.heavy_hitter_trimmer = asyncio.create_task(heavy_hitter_trimmer(app))
+    
+    # Register Lua scripts once; calls go through EVALSHA
+    app.state.rl_script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+    app.state.stats_script = redis_client.register_script(STATS_SCRIPT)
+    
+    # Shared HTTP client so external API calls reuse pooled connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
     )
     
-    # Create TimeSeries keys if they don't exist
-    try:
+    # In-process caches of rate limit and verification decisions
+    # Rate limit entries are (count, deadline) and expire at their own deadline
+    app.state.rl_blocked = TLRUCache(maxsize=DECISION_CACHE_SIZE, ttu=lambda _ip, entry, _now: entry[1])
+    app.state.verified_ips = TTLCache(maxsize=DECISION_CACHE_SIZE, ttl=VERIFICATION_TTL)
+    
+    # In-process caches of threat intelligence lookups
+    app.state.ti_cache = TTLCache(maxsize=THREAT_INTEL_CACHE_SIZE, ttl=THREAT_INTEL_CACHE_TTL)
+    app.state.ti_negative_cache = TTLCache(maxsize=THREAT_INTEL_CACHE_SIZE, ttl=THREAT_INTEL_NEGATIVE_CACHE_TTL)
+    
+    # Create TimeSeries keys if they don't exist, in a single round-trip
+    # (key, is_counter): counters sum samples that share a timestamp
+    ts_keys = [
         # Total requests per second
-        await redis_client.ts().create("ddos:total_rps", retention_msecs=86400000)  
-        await redis_client.ts().create("ddos:total_rps:avg", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:total_rps:std", retention_msecs=86400000)
+        ("ddos:total_rps", True),
+        ("ddos:total_rps:avg", False),
+        ("ddos:total_rps:std", False),
         
         # Requests per second by path
-        await redis_client.ts().create("ddos:path_rps", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:path_rps:avg", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:path_rps:std", retention_msecs=86400000)
+        ("ddos:path_rps", True),
+        ("ddos:path_rps:avg", False),
+        ("ddos:path_rps:std", False),
         
         # Requests per second by IP
-        await redis_client.ts().create("ddos:ip_rps", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:ip_rps:avg", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:ip_rps:std", retention_msecs=86400000)
+        ("ddos:ip_rps", True),
+        ("ddos:ip_rps:avg", False),
+        ("ddos:ip_rps:std", False),
         
         # Response times
-        await redis_client.ts().create("ddos:response_time", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:response_time:avg", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:response_time:std", retention_msecs=86400000)
+        ("ddos:response_time", False),
+        ("ddos:response_time:avg", False),
+        ("ddos:response_time:std", False),
         
         # Error rates
-        await redis_client.ts().create("ddos:error_rate", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:error_rate:avg", retention_msecs=86400000)
-        await redis_client.ts().create("ddos:error_rate:std", retention_msecs=86400000)
-        
+        ("ddos:error_rate", True),
+        ("ddos:error_rate:avg", False),
+        ("ddos:error_rate:std", False),
+    ]
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for key, is_counter in ts_keys:
+        args = ["TS.CREATE", key, "RETENTION", 86400000, "CHUNK_SIZE", TS_CHUNK_SIZE, "ENCODING", "COMPRESSED"]
+        if is_counter:
+            args.extend(("DUPLICATE_POLICY", "SUM"))
+        pipe.execute_command(*args)
+    results = await pipe.execute(raise_on_error=False)
+    
+    errors = [
+        result for result in results
+        if isinstance(result, ResponseError) and "already exists" not in str(result)
+    ]
+    
+    # Counters created before TS.MADD was used may still have the default BLOCK policy
+    existing_counters = [
+        key for (key, is_counter), result in zip(ts_keys, results)
+        if is_counter and isinstance(result, ResponseError) and "already exists" in str(result)
+    ]
+    if existing_counters:
+        await set_sum_policy(redis_client, existing_counters)
+    
+    if errors:
+        logger.error(f"Error creating Redis TimeSeries keys: {errors[0]}")
+    else:
         logger.info("Redis TimeSeries keys created successfully")
-    except ResponseError as e:
-        if "already exists" not in str(e):
-            logger.error(f"Error creating Redis TimeSeries keys: {e}")
-    finally:
-        await redis_client.close()
 
 
-# Middleware to track requests and response times
-@app.middleware("http")
-async def track_requests(request: Request, call_next):
-    # Get client IP
-    client_ip = request.client.host if request.client else "unknown"
-    path = request.url.path
-    
-    # Record start time
-    start_time = time.time()
-    
-    # Process request
-    response = await call_next(request)
-    
-    # Calculate response time
-    response_time = time.time() - start_time
-    
-    # Record metrics in Redis
-    redis_client = redis.Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        password=REDIS_PASSWORD,
-        decode_responses=True,
+# Release the shared Redis connection pool on shutdown
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.metric_flusher.cancel()
+    app.state.heavy_hitter_trimmer.cancel()
+    await app.state.http.aclose()
+    await app.state.redis.close()
+    await app.state.redis.connection_pool.disconnect()
+
+
+# Cached Redis key builders for the per-request hot path
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def path_key(path: str) -> str:
+    return f"ddos:path:{path}"
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def ip_key(ip: str) -> str:
+    return f"ddos:ip:{ip}"
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def stats_key(metric: str) -> str:
+    return f"ddos:stats:{metric}"
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def ratelimit_key(ip: str) -> str:
+    return f"ratelimit:{ip}"
+
+
+@lru_cache(maxsize=HEAVY_HITTER_BUCKETS)
+def heavy_hitter_keys(bucket: int) -> Tuple[str, str]:
+    return f"ddos:top_paths:{bucket}", f"ddos:top_ips:{bucket}"
+
+
+# Make existing counter series sum samples that share a timestamp, as TS.MADD can't
+async def set_sum_policy(redis_client: redis.Redis, keys: List[str]) -> None:
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command("TS.ALTER", key, "DUPLICATE_POLICY", "SUM")
+    results = await pipe.execute(raise_on_error=False)
+    
+    for key, result in zip(keys, results):
+        if isinstance(result, ResponseError):
+            logger.error(f"Error setting duplicate policy on {key}: {result}")
+
+
+# Create path/IP TimeSeries keys that this process hasn't seen yet
+async def ensure_ts_keys(redis_client: redis.Redis, keys: Set[str]) -> None:
+    known = app.state.known_ts_keys
+    # get() refreshes recency on hits; `in` would not, turning the LRU into a FIFO
+    new_keys = [key for key in keys if known.get(key) is None]
+    if not new_keys:
+        return
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for key in new_keys:
+        pipe.execute_command(
+            "TS.CREATE", key, "RETENTION", 86400000, "CHUNK_SIZE", TS_CHUNK_SIZE, "ENCODING", "COMPRESSED",
+            "DUPLICATE_POLICY", "SUM",
+        )
+    results = await pipe.execute(raise_on_error=False)
+    
+    existing = [
+        key for key, result in zip(new_keys, results)
+        if isinstance(result, ResponseError) and "already exists" in str(result)
+    ]
+    if existing:
+        await set_sum_policy(redis_client, existing)
+    
+    for key, result in zip(new_keys, results):
+        if not isinstance(result, ResponseError) or "already exists" in str(result):
+            known[key] = True
+
+
+# Write a batch of (key, timestamp, value) samples with a single TS.MADD
+async def write_samples(
+    redis_client: redis.Redis,
+    samples: List[Tuple[str, int, float]],
+    heavy_hitters: Dict[Tuple[str, str], int],
+) -> None:
+    args = []
+    for key, timestamp, value in samples:
+        args.extend((key, timestamp, value))
+    
+    # Streaming stats see the same per-millisecond values the SUM duplicate policy stores
+    points = {}
+    response_times = []
+    for key, timestamp, value in samples:
+        if key == "ddos:response_time":
+            response_times.append(value)
+        else:
+            points[(key, timestamp)] = points.get((key, timestamp), 0) + value
+    
+    stats_keys = [stats_key(key) for key, _ in points]
+    stats_keys.extend([stats_key("ddos:response_time")] * len(response_times))
+    stats_values = list(points.values()) + response_times
+    
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.execute_command("TS.MADD", *args)
+    await app.state.stats_script(
+        keys=stats_keys,
+        args=[EWMA_ALPHA, samples[-1][1], WINDOW_SIZE * 1000] + stats_values,
+        client=pipe,
     )
+    for (key, member), count in heavy_hitters.items():
+        pipe.zincrby(key, count, member)
+    for key in {key for key, _ in heavy_hitters}:
+        pipe.expire(key, HEAVY_HITTER_BUCKET * (HEAVY_HITTER_BUCKETS + 1))
+    results = (await pipe.execute())[0]
     
-    try:
-        timestamp = int(time.time() * 1000)  # Redis TimeSeries uses millisecond timestamps
+    # Forget keys whose samples were rejected so they are re-created on the next flush
+    for (key, _, _), result in zip(samples, results):
+        if isinstance(result, ResponseError):
+            app.state.known_ts_keys.pop(key, None)
+
+
+# Background task that drains the metric queue into batched TS.MADD writes
+async def metric_flusher(app: FastAPI):
+    queue = app.state.metric_queue
+    
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await queue.get()]
         
-        # Increment total RPS counter
-        await redis_client.ts().add("ddos:total_rps", timestamp, 1, duplicate_policy="sum")
+        # Keep collecting until the flush interval passes or the batch is full
+        deadline = loop.time() + METRIC_FLUSH_INTERVAL
+        while len(batch) < METRIC_FLUSH_BATCH_SIZE:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        samples = []
+        keys = set()
+        heavy_hitters = Counter()
+        for timestamp, path, client_ip, response_time, is_error in batch:
+            path_ts_key = path_key(path)
+            ip_ts_key = ip_key(client_ip)
+            keys.add(path_ts_key)
+            keys.add(ip_ts_key)
+            top_paths_key, top_ips_key = heavy_hitter_keys(timestamp // (HEAVY_HITTER_BUCKET * 1000))
+            heavy_hitters[(top_paths_key, path)] += 1
+            heavy_hitters[(top_ips_key, client_ip)] += 1
+            samples.extend((
+                ("ddos:total_rps", timestamp, 1),
+                (path_ts_key, timestamp, 1),
+                (ip_ts_key, timestamp, 1),
+                ("ddos:response_time", timestamp, response_time),
+                ("ddos:error_rate", timestamp, is_error),
+            ))
         
-        # Increment path-specific RPS counter
-        path_key = f"ddos:path:{path}"
         try:
-            await redis_client.ts().add(path_key, timestamp, 1, duplicate_policy="sum")
-        except ResponseError:
-            await redis_client.ts().create(path_key, retention_msecs=86400000)
-            await redis_client.ts().add(path_key, timestamp, 1, duplicate_policy="sum")
+            await ensure_ts_keys(app.state.redis, keys)
+            await write_samples(app.state.redis, samples, heavy_hitters)
+        except Exception as e:
+            logger.error(f"Error recording metrics: {e}")
+
+
+# Background task that caps the size of the current heavy hitter buckets
+async def heavy_hitter_trimmer(app: FastAPI):
+    while True:
+        await asyncio.sleep(HEAVY_HITTER_BUCKET)
         
-        # Increment IP-specific RPS counter
-        ip_key = f"ddos:ip:{client_ip}"
+        bucket = int(time.time()) // HEAVY_HITTER_BUCKET
         try:
-            await redis_client.ts().add(ip_key, timestamp, 1, duplicate_policy="sum")
-        except ResponseError:
-            await redis_client.ts().create(ip_key, retention_msecs=86400000)
-            await redis_client.ts().add(ip_key, timestamp, 1, duplicate_policy="sum")
+            pipe = app.state.redis.pipeline(transaction=False)
+            for name in ("ddos:top_paths", "ddos:top_ips"):
+                for key in (f"{name}:{bucket - 1}", f"{name}:{bucket}"):
+                    pipe.zremrangebyrank(key, 0, -(HEAVY_HITTER_SIZE + 1))
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error trimming heavy hitters: {e}")
+
+
+# Top members of a heavy hitter sorted set over the last hour
+async def top_hitters(redis_client: redis.Redis, name: str, count: int) -> List[Tuple[str, float]]:
+    bucket = int(time.time()) // HEAVY_HITTER_BUCKET
+    keys = [f"{name}:{bucket - i}" for i in range(HEAVY_HITTER_BUCKETS)]
+    
+    pipe = redis_client.pipeline()
+    pipe.zunionstore(f"{name}:last_hour", keys)
+    pipe.expire(f"{name}:last_hour", HEAVY_HITTER_BUCKET)
+    pipe.zrevrange(f"{name}:last_hour", 0, count - 1, withscores=True)
+    return (await pipe.execute())[-1]
+
+
+# Middleware to track requests and response times
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        # Record response time
-        await redis_client.ts().add("ddos:response_time", timestamp, response_time)
+        # Get client IP
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        path = scope["path"]
         
-        # Record error rate (1 for error, 0 for success)
-        is_error = 1 if response.status_code >= 400 else 0
-        await redis_client.ts().add("ddos:error_rate", timestamp, is_error, duplicate_policy="sum")
+        # Record start time
+        start_time = time.perf_counter()
         
-    except Exception as e:
-        logger.error(f"Error recording metrics: {e}")
-    finally:
-        await redis_client.close()
-    
-    return response
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # Calculate response time
+                response_time = time.perf_counter() - start_time
+                
+                # Queue metrics for the background flusher
+                timestamp = int(time.time() * 1000)  # Redis TimeSeries uses millisecond timestamps
+                is_error = 1 if message["status"] >= 400 else 0  # 1 for error, 0 for success
+                try:
+                    app.state.metric_queue.put_nowait((timestamp, path, client_ip, response_time, is_error))
+                except asyncio.QueueFull:
+                    pass  # Shed metrics rather than slow down requests
+            
+            await send(message)
+        
+        # Process request
+        await self.app(scope, receive, send_wrapper)
+
+
+app.add_middleware(MetricsMiddleware)
 
 
 # Real-time Z-score anomaly detection
@@ -218,28 +501,22 @@ async def detect_anomalies(redis_client: redis.Redis, metric: str) -> AnomalyDet
     current_time = int(time.time() * 1000)
     start_time = current_time - (WINDOW_SIZE * 1000)
     
-    # Get recent data points
-    try:
-        data = await redis_client.ts().range(
-            metric,
-            from_time=start_time,
-            to_time=current_time,
-        )
-    except ResponseError:
-        logger.warning(f"TimeSeries key {metric} not found")
+    # Read the streaming statistics kept up to date by the metric flusher
+    stats = await redis_client.hgetall(stats_key(metric))
+    if not stats or int(stats["ts"]) < start_time:
+        logger.info(f"No recent data points for {metric}")
         return None
     
-    if not data or len(data) < MIN_DATA_POINTS:
+    # Decay the stored count to now so it approximates points in the last window
+    age = current_time - int(stats["ts"])
+    if float(stats["count"]) * math.exp(-max(age, 0) / (WINDOW_SIZE * 1000)) < MIN_DATA_POINTS:
         logger.info(f"Not enough data points for {metric}")
         return None
     
-    # Calculate current value (most recent data point)
-    current_value = data[-1][1] if data else 0
-    
-    # Calculate average and standard deviation
-    values = [point[1] for point in data]
-    avg = sum(values) / len(values)
-    std_dev = (sum((x - avg) ** 2 for x in values) / len(values)) ** 0.5
+    # Current value (most recent data point), average and standard deviation
+    current_value = float(stats["value"])
+    avg = float(stats["mu"])
+    std_dev = max(float(stats["var"]), 0.0) ** 0.5
     
     # Avoid division by zero
     if std_dev == 0:
@@ -250,9 +527,11 @@ async def detect_anomalies(redis_client: redis.Redis, metric: str) -> AnomalyDet
     # Check if the value is anomalous
     is_anomaly = abs(zscore) > ZSCORE_THRESHOLD
     
-    # Store the average and standard deviation for this metric
-    await redis_client.ts().add(f"{metric}:avg", current_time, avg)
-    await redis_client.ts().add(f"{metric}:std", current_time, std_dev)
+    # Store the average and standard deviation for this metric in one round-trip
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.execute_command("TS.ADD", f"{metric}:avg", current_time, avg)
+    pipe.execute_command("TS.ADD", f"{metric}:std", current_time, std_dev)
+    await pipe.execute()
     
     return AnomalyDetectionResult(
         timestamp=current_time / 1000,  # Convert back to seconds
@@ -264,81 +543,108 @@ async def detect_anomalies(redis_client: redis.Redis, metric: str) -> AnomalyDet
     )
 
 
+# Await coroutines concurrently in chunks to bound in-flight Redis requests
+async def gather_chunked(coros: Iterable[Awaitable], chunk_size: int = GATHER_CHUNK_SIZE) -> List:
+    # Coroutines are created one chunk at a time, so none are left un-awaited if a chunk raises
+    coros = iter(coros)
+    results = []
+    while chunk := list(islice(coros, chunk_size)):
+        results.extend(await asyncio.gather(*chunk))
+    return results
+
+
 # Check rate limits for an IP
 async def check_rate_limit(redis_client: redis.Redis, ip: str) -> Tuple[bool, int]:
-    current_time = int(time.time())
-    key = f"ratelimit:{ip}"
-    
-    # Get the current count
-    count = await redis_client.get(key)
-    count = int(count) if count else 0
-    
-    # Check if the IP is rate limited
-    if count >= RATE_LIMIT_MAX_REQUESTS:
+    # IPs already over the limit are answered without touching Redis
+    blocked = app.state.rl_blocked
+    entry = blocked.get(ip)
+    if entry is not None:
+        return True, entry[0]
+    
+    # Increment the counter and start the window atomically in one round-trip
+    count, ttl_ms = await app.state.rl_script(keys=[ratelimit_key(ip)], args=[RATE_LIMIT_WINDOW], client=redis_client)
+    count = int(count)
+    
+    # Check if the IP is rate limited; the local entry expires with the Redis window
+    if count > RATE_LIMIT_MAX_REQUESTS:
+        blocked[ip] = (count, time.monotonic() + int(ttl_ms) / 1000)
         return True, count
     
-    # Increment the counter
-    pipe = redis_client.pipeline()
-    await pipe.incr(key)
-    await pipe.expire(key, RATE_LIMIT_WINDOW)
-    await pipe.execute()
-    
-    return False, count + 1
+    return False, count
 
 
 # Check an IP against threat intelligence
 async def check_threat_intel(ip: str) -> ThreatIntelResult:
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{THREAT_INTEL_API_URL}?ip={ip}",
-                headers={"Authorization": f"Bearer {THREAT_INTEL_API_KEY}"},
-                timeout=2.0,  # Short timeout to avoid blocking
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return ThreatIntelResult(**data)
-            else:
-                logger.warning(f"Failed to check threat intelligence for {ip}: {response.status_code}")
-                return None
-        except Exception as e:
-            logger.error(f"Error checking threat intelligence: {e}")
+    # Repeat lookups are answered from the in-process caches
+    result = app.state.ti_cache.get(ip, _MISS)
+    if result is _MISS:
+        result = app.state.ti_negative_cache.get(ip, _MISS)
+    if result is not _MISS:
+        return result
+    
+    result = await fetch_threat_intel(ip)
+    
+    # Failed and low-risk lookups expire sooner so transient errors don't stick
+    if result and result.risk_score > THREAT_INTEL_RISK_THRESHOLD:
+        app.state.ti_cache[ip] = result
+    else:
+        app.state.ti_negative_cache[ip] = result
+    return result
+
+
+# Query the threat intelligence API for an IP
+async def fetch_threat_intel(ip: str) -> ThreatIntelResult:
+    client = app.state.http
+    try:
+        response = await client.get(
+            f"{THREAT_INTEL_API_URL}?ip={ip}",
+            headers={"Authorization": f"Bearer {THREAT_INTEL_API_KEY}"},
+            timeout=2.0,  # Short timeout to avoid blocking
+        )
+        
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            return ThreatIntelResult(**data)
+        else:
+            logger.warning(f"Failed to check threat intelligence for {ip}: {response.status_code}")
             return None
+    except Exception as e:
+        logger.error(f"Error checking threat intelligence: {e}")
+        return None
 
 
 # Add an IP to Cloudflare's firewall
 async def add_to_cloudflare_blocklist(ip: str, duration: int = 3600) -> bool:
-    async with httpx.AsyncClient() as client:
-        try:
-            # Create a firewall rule to block the IP
-            response = await client.post(
-                f"{CLOUDFLARE_API_URL}/zones/{CLOUDFLARE_ZONE_ID}/firewall/rules",
-                headers={
-                    "X-Auth-Email": CLOUDFLARE_EMAIL,
-                    "X-Auth-Key": CLOUDFLARE_API_KEY,
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "description": f"DDoS Protection - Automatically blocked {ip}",
-                    "action": "block",
-                    "filter": {
-                        "expression": f"ip.src eq {ip}",
-                        "paused": False,
-                    },
-                    "priority": 1,
+    client = app.state.http
+    try:
+        # Create a firewall rule to block the IP
+        response = await client.post(
+            f"{CLOUDFLARE_API_URL}/zones/{CLOUDFLARE_ZONE_ID}/firewall/rules",
+            headers={
+                "X-Auth-Email": CLOUDFLARE_EMAIL,
+                "X-Auth-Key": CLOUDFLARE_API_KEY,
+                "Content-Type": "application/json",
+            },
+            json={
+                "description": f"DDoS Protection - Automatically blocked {ip}",
+                "action": "block",
+                "filter": {
+                    "expression": f"ip.src eq {ip}",
+                    "paused": False,
                 },
-            )
-            
-            if response.status_code in (200, 201):
-                logger.info(f"Successfully added {ip} to Cloudflare blocklist")
-                return True
-            else:
-                logger.warning(f"Failed to add {ip} to Cloudflare blocklist: {response.status_code}, {response.text}")
-                return False
-        except Exception as e:
-            logger.error(f"Error adding IP to Cloudflare blocklist: {e}")
+                "priority": 1,
+            },
+        )
+        
+        if response.status_code in (200, 201):
+            logger.info(f"Successfully added {ip} to Cloudflare blocklist")
+            return True
+        else:
+            logger.warning(f"Failed to add {ip} to Cloudflare blocklist: {response.status_code}, {response.text}")
             return False
+    except Exception as e:
+        logger.error(f"Error adding IP to Cloudflare blocklist: {e}")
+        return False
 
 
 # Endpoint for client verification
@@ -350,7 +656,7 @@ async def verify_client(
     ip = request.clientIP
     
     # Check if the IP is already verified
-    is_verified = await redis_client.get(f"verified:{ip}")
+    is_verified = ip in app.state.verified_ips or await redis_client.get(f"verified:{ip}")
     if is_verified:
         return {"verified": True, "verification_type": "cached"}
     
@@ -361,7 +667,7 @@ async def verify_client(
     
     # Check threat intelligence
     threat_intel = await check_threat_intel(ip)
-    if threat_intel and threat_intel.risk_score > 70:
+    if threat_intel and threat_intel.risk_score > THREAT_INTEL_RISK_THRESHOLD:
         # Auto-block high-risk IPs
         await add_to_cloudflare_blocklist(ip)
         await redis_client.set(f"blocked:{ip}", "threat_intel", ex=3600)
@@ -376,7 +682,8 @@ async def verify_client(
         return {"verified": False, "verification_type": "js_challenge"}
     else:
         # Low count just requires a cookie
-        await redis_client.set(f"verified:{ip}", "cookie", ex=3600)
+        await redis_client.set(f"verified:{ip}", "cookie", ex=VERIFICATION_TTL)
+        app.state.verified_ips[ip] = True
         return {"verified": True, "verification_type": "cookie"}
 
 
@@ -402,49 +709,39 @@ async def get_anomalies(
     if error_rate_anomaly and error_rate_anomaly.is_anomaly:
         anomalies.append(error_rate_anomaly)
     
-    # Check for top 10 paths by request volume
-    top_paths = []
-    cursor = b"0"
-    pattern = "ddos:path:*"
-    
-    while cursor:
-        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=100)
-        for key in keys:
-            if ":avg" not in key and ":std" not in key:
-                path_anomaly = await detect_anomalies(redis_client, key)
-                if path_anomaly and path_anomaly.is_anomaly:
-                    anomalies.append(path_anomaly)
-                    top_paths.append((key, path_anomaly.value))
-        
-        if cursor == b"0":
-            break
+    # Check the busiest paths and IPs concurrently, a chunk at a time
+    candidate_paths = await top_hitters(redis_client, "ddos:top_paths", ANOMALY_CANDIDATES)
+    path_anomalies = await gather_chunked(
+        detect_anomalies(redis_client, path_key(path)) for path, _ in candidate_paths
+    )
+    for path_anomaly in path_anomalies:
+        if path_anomaly and path_anomaly.is_anomaly:
+            anomalies.append(path_anomaly)
     
-    # Check for top IPs by request volume
     top_ips = []
-    cursor = b"0"
-    pattern = "ddos:ip:*"
-    
-    while cursor:
-        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=100)
-        for key in keys:
-            if ":avg" not in key and ":std" not in key:
-                ip_anomaly = await detect_anomalies(redis_client, key)
-                if ip_anomaly and ip_anomaly.is_anomaly:
-                    anomalies.append(ip_anomaly)
-                    
-                    # Extract IP from key
-                    ip = key.split(":")[-1]
-                    top_ips.append((ip, ip_anomaly.value))
-        
-        if cursor == b"0":
-            break
-    
-    # Auto-block IPs with anomalous behavior
-    for ip, value in top_ips:
-        if value > 100:  # Threshold for automatic blocking
-            await add_to_cloudflare_blocklist(ip)
-            await redis_client.set(f"blocked:{ip}", "auto_anomaly", ex=3600)
-            logger.info(f"Auto-blocked anomalous IP: {ip} with value {value}")
+    candidate_ips = await top_hitters(redis_client, "ddos:top_ips", ANOMALY_CANDIDATES)
+    ip_anomalies = await gather_chunked(
+        detect_anomalies(redis_client, ip_key(ip)) for ip, _ in candidate_ips
+    )
+    for (ip, _), ip_anomaly in zip(candidate_ips, ip_anomalies):
+        if ip_anomaly and ip_anomaly.is_anomaly:
+            anomalies.append(ip_anomaly)
+            top_ips.append((ip, ip_anomaly.value))
+    
+    # Auto-block IPs with anomalous behavior, a bounded number at a time
+    semaphore = asyncio.Semaphore(AUTO_BLOCK_CONCURRENCY)
+    
+    async def block_ip(ip: str, value: float):
+        async with semaphore:
+            if await add_to_cloudflare_blocklist(ip):
+                await redis_client.set(f"blocked:{ip}", "auto_anomaly", ex=3600)
+                logger.info(f"Auto-blocked anomalous IP: {ip} with value {value}")
+    
+    await asyncio.gather(*(
+        block_ip(ip, value)
+        for ip, value in top_ips
+        if value > 100  # Threshold for automatic blocking
+    ))
     
     return anomalies
 
@@ -508,71 +805,12 @@ async def get_metrics(
     except ResponseError:
         error_rates = []
     
-    # Get top paths
-    top_paths = []
-    cursor = b"0"
-    pattern = "ddos:path:*"
-    path_values = []
-    
-    while cursor:
-        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=100)
-        for key in keys:
-            if ":avg" not in key and ":std" not in key:
-                try:
-                    path_data = await redis_client.ts().range(
-                        key,
-                        from_time=start_time,
-                        to_time=current_time,
-                        aggregation_type="sum",
-                        bucket_size_msec=3600000,  # 1 hour bucket
-                    )
-                    
-                    if path_data:
-                        path = key.replace("ddos:path:", "")
-                        value = path_data[0][1]
-                        path_values.append((path, value))
-                except ResponseError:
-                    continue
-        
-        if cursor == b"0":
-            break
+    # Get top 10 paths and IPs by request count
+    path_values = await top_hitters(redis_client, "ddos:top_paths", 10)
+    top_paths = [{"path": path, "requests": value} for path, value in path_values]
     
-    # Sort paths by request count and take top 10
-    path_values.sort(key=lambda x: x[1], reverse=True)
-    top_paths = [{"path": path, "requests": value} for path, value in path_values[:10]]
-    
-    # Get top IPs
-    top_ips = []
-    cursor = b"0"
-    pattern = "ddos:ip:*"
-    ip_values = []
-    
-    while cursor:
-        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=100)
-        for key in keys:
-            if ":avg" not in key and ":std" not in key:
-                try:
-                    ip_data = await redis_client.ts().range(
-                        key,
-                        from_time=start_time,
-                        to_time=current_time,
-                        aggregation_type="sum",
-                        bucket_size_msec=3600000,  # 1 hour bucket
-                    )
-                    
-                    if ip_data:
-                        ip = key.replace("ddos:ip:", "")
-                        value = ip_data[0][1]
-                        ip_values.append((ip, value))
-                except ResponseError:
-                    continue
-        
-        if cursor == b"0":
-            break
-    
-    # Sort IPs by request count and take top 10
-    ip_values.sort(key=lambda x: x[1], reverse=True)
-    top_ips = [{"ip": ip, "requests": value} for ip, value in ip_values[:10]]
+    ip_values = await top_hitters(redis_client, "ddos:top_ips", 10)
+    top_ips = [{"ip": ip, "requests": value} for ip, value in ip_values]
     
     # Get blocked IPs
     blocked_ips = []
@@ -580,11 +818,15 @@ async def get_metrics(
     pattern = "blocked:*"
     
     while cursor:
-        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=100)
-        for key in keys:
-            ip = key.replace("blocked:", "")
-            reason = await redis_client.get(key)
-            blocked_ips.append({"ip": ip, "reason": reason})
+        cursor, keys = await redis_client.scan(cursor=cursor, match=pattern, count=1000)
+        if keys:
+            # Fetch every reason on this page in one round-trip
+            reasons = await redis_client.mget(keys)
+            blocked_ips.extend(
+                {"ip": key.replace("blocked:", ""), "reason": reason}
+                for key, reason in zip(keys, reasons)
+                if reason is not None  # Expired since the scan
+            )
         
         if cursor == b"0":
             break
@@ -613,33 +855,33 @@ async def add_mitigation(
         return {"success": success}
     elif action.action_type == "challenge":
         # Add a challenge rule in Cloudflare
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{CLOUDFLARE_API_URL}/zones/{CLOUDFLARE_ZONE_ID}/firewall/rules",
-                    headers={
-                        "X-Auth-Email": CLOUDFLARE_EMAIL,
-                        "X-Auth-Key": CLOUDFLARE_API_KEY,
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "description": f"DDoS Protection - Challenge {action.target}",
-                        "action": "challenge",
-                        "filter": {
-                            "expression": f"ip.src eq {action.target}",
-                            "paused": False,
-                        },
-                        "priority": 2,
+        client = app.state.http
+        try:
+            response = await client.post(
+                f"{CLOUDFLARE_API_URL}/zones/{CLOUDFLARE_ZONE_ID}/firewall/rules",
+                headers={
+                    "X-Auth-Email": CLOUDFLARE_EMAIL,
+                    "X-Auth-Key": CLOUDFLARE_API_KEY,
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "description": f"DDoS Protection - Challenge {action.target}",
+                    "action": "challenge",
+                    "filter": {
+                        "expression": f"ip.src eq {action.target}",
+                        "paused": False,
                     },
-                )
-                
-                success = response.status_code in (200, 201)
-                if success:
-                    await redis_client.set(f"challenged:{action.target}", action.reason, ex=action.duration)
-                return {"success": success}
-            except Exception as e:
-                logger.error(f"Error adding challenge rule: {e}")
-                return {"success": False}
+                    "priority": 2,
+                },
+            )
+            
+            success = response.status_code in (200, 201)
+            if success:
+                await redis_client.set(f"challenged:{action.target}", action.reason, ex=action.duration)
+            return {"success": success}
+        except Exception as e:
+            logger.error(f"Error adding challenge rule: {e}")
+            return {"success": False}
     else:
         # Just monitor the IP
         await redis_client.set(f"monitored:{action.target}", action.reason, ex=action.duration)
@@ -654,4 +896,13 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Each worker builds its own pools, caches and background tasks in startup_event
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=5000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        log_level="info",
+    )
\ No newline at end of file